@@ -4,28 +4,42 @@
 """
 企业微信可信IP自动更新器
 监测多条线路的公网IP，变化时通过 Selenium 更新企业微信后台配置。
+
+selenium / requests 按需在函数内导入，detect、keepalive 等子命令无需加载浏览器依赖。
 """
 
+from __future__ import annotations
+
+import argparse
+import atexit
+import copy
+import cProfile
+import gzip
 import ipaddress
 import json
 import logging
+import logging.handlers
+import marshal
 import os
 import platform
+import queue
 import random
 import re
+import signal
 import subprocess
 import sys
+import threading
 import time
+import tracemalloc
+import uuid
+from contextlib import contextmanager
 from datetime import datetime
 from pathlib import Path
+from typing import TYPE_CHECKING
 
-import requests
-from selenium import webdriver
-from selenium.common.exceptions import TimeoutException, WebDriverException
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.support.ui import WebDriverWait
+if TYPE_CHECKING:
+    from selenium import webdriver
+    from selenium.webdriver.chrome.service import Service
 
 try:
     import netifaces
@@ -33,13 +47,203 @@ except ImportError:
     netifaces = None
 
 # ==================== 日志配置 ====================
-logging.basicConfig(
-    level=logging.INFO,
-    format="[%(asctime)s] %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-)
+LOG_FORMAT = "[%(asctime)s] %(message)s"
+LOG_DATEFMT = "%Y-%m-%d %H:%M:%S"
+# JSON 行日志中输出的结构化字段（通过 extra= 或周期上下文注入）
+LOG_FIELDS = ("cycle_id", "phase", "interface", "service", "latency", "suppressed")
+# 限流窗口（秒）：需覆盖多个检测周期（detailsTime 300~1800s）才能抑制每周期重复的日志
+LOG_RATE_WINDOW = 3600
+# 异步日志队列容量：写出端卡住时超出部分直接丢弃并计数，而不是无限占用内存
+LOG_QUEUE_SIZE = 10000
+
 log = logging.getLogger(__name__)
 
+# 当前周期的日志上下文（cycle_id / phase），由主流程维护
+_log_context: dict[str, str] = {}
+_log_listener: logging.handlers.QueueListener | None = None
+
+
+def set_log_context(**fields):
+    """设置/清除当前周期的日志上下文，值为 None 时移除该字段"""
+    for key, value in fields.items():
+        if value is None:
+            _log_context.pop(key, None)
+        else:
+            _log_context[key] = value
+
+
+class LogContextFilter(logging.Filter):
+    """把周期上下文写入日志记录（在产生日志的线程中执行）"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        for key, value in _log_context.items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    对 INFO 及以下的重复日志限流：按格式化后的完整消息计数（不同线路/IP 的结果互不影响），
+    每个窗口内同一消息最多放行 burst 条，超出的丢弃并计数，下个窗口第一条放行时带上 suppressed 字段。
+    """
+
+    # 消息种类超过该数量时清理已过期且无待报告计数的条目，避免内存增长
+    MAX_BUCKETS = 1000
+
+    def __init__(self, burst: int, window: float = LOG_RATE_WINDOW):
+        super().__init__()
+        self.burst = burst
+        self.window = window
+        self._buckets: dict[str, list] = {}  # message -> [window_start, count, suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.INFO:
+            return True
+        key = record.getMessage()
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None or now - bucket[0] >= self.window:
+                suppressed = bucket[2] if bucket else 0
+                if bucket is None and len(self._buckets) >= self.MAX_BUCKETS:
+                    self._prune(now)
+                self._buckets[key] = [now, 1, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+                return True
+            if bucket[1] < self.burst:
+                bucket[1] += 1
+                return True
+            bucket[2] += 1
+            return False
+
+    def _prune(self, now: float):
+        for key in [k for k, (start, _, suppressed) in self._buckets.items()
+                    if suppressed == 0 and now - start >= self.window]:
+            del self._buckets[key]
+
+
+class TextFormatter(logging.Formatter):
+    """默认的人类可读格式；被限流丢弃过的消息在末尾注明省略条数"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        suppressed = getattr(record, "suppressed", None)
+        if suppressed:
+            text += f" (此前已省略 {suppressed} 条相同日志)"
+        return text
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """每条日志输出一行 JSON，便于日志采集端解析"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).astimezone().isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "msg": record.getMessage(),
+        }
+        for key in LOG_FIELDS:
+            value = getattr(record, key, None)
+            if value is not None:
+                entry[key] = round(value, 3) if isinstance(value, float) else value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class DeferredFormatQueueHandler(logging.handlers.QueueHandler):
+    """
+    入队前只渲染消息文本（参数可能随后被修改），保留 exc_info 等原始字段，
+    由监听线程中的格式化器统一输出（JSON 模式下异常进入 exc 字段而不是 msg）。
+    队列有界且入队不阻塞：队列满时丢弃日志并计数，恢复后补发一条丢弃提示。
+    """
+
+    def __init__(self, q: queue.Queue):
+        super().__init__(q)
+        self.dropped = 0  # 由 Handler.handle 的锁保护
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            notice = logging.LogRecord(log.name, logging.WARNING, __file__, 0,
+                                       "日志队列已满，丢弃了 %d 条日志", (dropped,), None)
+            try:
+                self.queue.put_nowait(self.prepare(notice))
+            except queue.Full:
+                self.dropped += dropped
+
+
+class DrainingQueueListener(logging.handlers.QueueListener):
+    """停止时等待队列腾出空间再放入结束标记（有界队列满时 put_nowait 会失败）"""
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel, timeout=5)
+
+
+def stop_log_listener():
+    """停止异步日志线程并写出队列中剩余的日志"""
+    global _log_listener
+    if _log_listener is not None:
+        try:
+            _log_listener.stop()
+        except queue.Full:
+            # 写出端一直卡住：放弃剩余日志，监听线程是守护线程，不阻塞退出
+            pass
+        _log_listener = None
+
+
+atexit.register(stop_log_listener)
+
+
+def setup_logging(fmt: str = "text", use_queue: bool = False, rate_limit: int = 0,
+                  rate_window: float = LOG_RATE_WINDOW):
+    """
+    配置根日志。fmt 为 text（默认，人类可读）或 json（JSON 行）；
+    use_queue 时经 QueueHandler 入队、由后台线程写出，慢管道不会阻塞主循环；
+    rate_limit > 0 时同一条 INFO 日志每 rate_window 秒最多输出该条数。
+    """
+    global _log_listener
+    stop_log_listener()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+
+    stream = logging.StreamHandler()
+    if fmt == "json":
+        stream.setFormatter(JsonLinesFormatter())
+    else:
+        stream.setFormatter(TextFormatter(LOG_FORMAT, LOG_DATEFMT))
+
+    handler: logging.Handler = stream
+    if use_queue:
+        q: queue.Queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        handler = DeferredFormatQueueHandler(q)
+        _log_listener = DrainingQueueListener(q, stream)
+        _log_listener.start()
+
+    handler.addFilter(LogContextFilter())
+    if rate_limit > 0:
+        handler.addFilter(RateLimitFilter(rate_limit, rate_window))
+    root.addHandler(handler)
+    root.setLevel(logging.INFO)
+
+
+setup_logging()
+
 # ==================== 常量 ====================
 IP_PATTERN = re.compile(r"\b(?:\d{1,3}\.){3}\d{1,3}\b")
 ISP_NAMES = {
@@ -86,14 +290,47 @@ INTERFACE_ISP_PRIORITY = {
 # Chrome 重试配置
 CHROME_MAX_RETRIES = 3
 CHROME_RETRY_DELAY = 5
+# 浏览器优雅退出的期限（秒），超时后强制结束其进程组
+CHROME_QUIT_TIMEOUT = 5
+
+# 退出码：配置缺失/无效、curl 不可用等运行环境问题返回 EXIT_ENV_ERROR
+EXIT_OK = 0
+EXIT_FAILURE = 1
+EXIT_ENV_ERROR = 2
+
+# 单个周期的总时限（秒），超时后取消未完成的探测并结束浏览器
+CYCLE_TIMEOUT = 240
+# requests 单次请求超时（秒）：IP 探测后备 / cookie 保活
+REQUESTS_PROBE_TIMEOUT = 10
+KEEPALIVE_TIMEOUT = 15
+# 取消后等待工作线程退出的时间（秒）。取消时 curl/chromedriver 被 kill、
+# requests 调用被放弃等待（CycleDeadline.call），剩下的只有浏览器清理：
+# teardown_browser 最多 CHROME_QUIT_TIMEOUT + 1 秒，再留少量余量
+CYCLE_CANCEL_GRACE = CHROME_QUIT_TIMEOUT + 5
 
 # 错误/恢复通知限流（秒）
 NOTIFICATION_COOLDOWN = 86400  # 24h
 
+# 性能剖析：默认目录、容量预算、每次剖析的周期数与 RSS 采样间隔
+PROFILE_DIR = "config/profiles"
+PROFILE_MAX_BYTES = 50 * 1024 * 1024  # 50MB
+PROFILE_MAX_COUNT = 30
+PROFILE_CYCLES = 3
+PROFILE_RSS_INTERVAL = 0.5
+PROFILE_TOP_ALLOCATIONS = 30
+
+# 失败现场快照：默认目录与容量预算
+ARTIFACT_DIR = "config/artifacts"
+ARTIFACT_MAX_BYTES = 20 * 1024 * 1024  # 20MB
+ARTIFACT_MAX_COUNT = 50
+# HTML 快照截断长度（字符），避免整页 DOM 过大
+ARTIFACT_HTML_LIMIT = 200_000
+
 
 # ==================== 配置管理 ====================
 CONFIG_DIR = Path("config")
 CONFIG_PATH = CONFIG_DIR / "updater-config.json"
+STATE_PATH = CONFIG_DIR / "updater-state.json"
 
 DEFAULT_CONFIG = {
     "Settings": {
@@ -105,6 +342,18 @@ DEFAULT_CONFIG = {
         "detailsTime": 300,
         "webhook_url": "",
         "error_report_file": "error_report.json",
+        "artifact_dir": ARTIFACT_DIR,
+        "artifact_max_bytes": ARTIFACT_MAX_BYTES,
+        "artifact_max_count": ARTIFACT_MAX_COUNT,
+        "state_file": str(STATE_PATH),
+        "cycle_timeout": CYCLE_TIMEOUT,
+        "log_format": "text",
+        "log_queue": False,
+        "log_rate_limit": 0,
+        "log_rate_window": LOG_RATE_WINDOW,
+        "profile_on_start": False,
+        "profile_cycles": PROFILE_CYCLES,
+        "profile_dir": PROFILE_DIR,
     }
 }
 
@@ -126,20 +375,189 @@ def create_default_config() -> bool:
 
 
 def load_config() -> dict:
-    """加载配置文件，不存在则创建默认配置"""
+    """加载配置文件，不存在则创建默认配置；此时没有可用配置，以 EXIT_ENV_ERROR 退出"""
     if not CONFIG_PATH.exists():
         log.info("配置文件不存在，正在创建默认配置...")
         create_default_config()
-        sys.exit(0)
+        sys.exit(EXIT_ENV_ERROR)
     try:
         config = json.loads(CONFIG_PATH.read_text(encoding="utf-8"))
         log.info("配置文件加载成功")
         return config
     except Exception as e:
         log.error("加载配置文件失败: %s", e)
-        if create_default_config():
-            sys.exit(0)
-        sys.exit(1)
+        create_default_config()
+        sys.exit(EXIT_ENV_ERROR)
+
+
+def load_state(path: Path) -> dict:
+    """读取上次运行保存的状态（已设置的 IP、通知限流），不存在或损坏时返回空状态"""
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        log.warning("读取状态文件失败，忽略: %s", e)
+        return {}
+
+
+def save_state(path: Path, state: dict):
+    """原子写入状态文件"""
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.write_text(json.dumps(state, ensure_ascii=False, indent=4), encoding="utf-8")
+        os.replace(tmp, path)
+    except OSError as e:
+        log.warning("保存状态文件失败: %s", e)
+
+
+# ==================== 周期时限 ====================
+class CycleCancelled(BaseException):
+    """
+    周期超时被取消。继承 BaseException（同 asyncio.CancelledError），
+    以免被各处探测/重试逻辑中的 `except Exception` 吞掉。
+    phase 记录抛出时所在的阶段（随后的 finally 清理会改写日志上下文）。
+    """
+
+    def __init__(self, phase: str = "-"):
+        super().__init__(phase)
+        self.phase = phase
+
+
+class CycleDeadline:
+    """
+    单个周期的时限与取消句柄。curl 进程、chromedriver 服务登记到这里，
+    超时后由监督线程 cancel() 统一 kill，阻塞在它们上的调用随之返回。
+    requests 调用（DNS、重定向、逐次读取的超时都无法限定总时长）经 call()
+    放到守护线程中执行，取消时工作线程直接放弃等待，遗留的请求线程自行超时结束。
+    budget 为 None 时不限时（detect/bench 等子命令直接调用时）。
+    """
+
+    def __init__(self, budget: float | None = None):
+        self.expires_at = time.monotonic() + budget if budget is not None else None
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+        self._resources: list = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def remaining(self) -> float:
+        if self.expires_at is None:
+            return float("inf")
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def check(self):
+        """已取消或已超时则抛出 CycleCancelled"""
+        if self.cancelled or self.remaining() <= 0:
+            raise CycleCancelled(_log_context.get("phase", "-"))
+
+    def timeout(self, limit: float) -> float:
+        """把单次调用的超时收紧到剩余时限以内"""
+        self.check()
+        return min(limit, self.remaining())
+
+    def sleep(self, seconds: float):
+        """可被取消的 sleep，睡到时限时抛出 CycleCancelled"""
+        self._cancelled.wait(self.timeout(seconds))
+        self.check()
+
+    def call(self, fn, *args, **kwargs):
+        """
+        在守护线程中执行无法从外部中断的阻塞调用，最多等到时限或取消；
+        放弃等待时抛出 CycleCancelled，调用本身的异常原样抛出。
+        """
+        self.check()
+        if self.expires_at is None:
+            return fn(*args, **kwargs)
+
+        outcome: dict = {}
+        done = threading.Event()
+
+        def _run():
+            try:
+                outcome["result"] = fn(*args, **kwargs)
+            except BaseException as e:
+                outcome["error"] = e
+            finally:
+                done.set()
+
+        self.register(done)
+        try:
+            threading.Thread(target=_run, name="blocking-call", daemon=True).start()
+            done.wait(self.remaining())
+        finally:
+            self.unregister(done)
+        if "error" in outcome:
+            raise outcome["error"]
+        if "result" not in outcome:
+            raise CycleCancelled(_log_context.get("phase", "-"))
+        return outcome["result"]
+
+    def register(self, resource):
+        with self._lock:
+            self._resources.append(resource)
+        if self.cancelled:
+            self._release(resource)
+
+    def unregister(self, resource):
+        with self._lock:
+            if resource in self._resources:
+                self._resources.remove(resource)
+
+    def cancel(self):
+        """
+        标记取消，强制结束所有登记的进程，并唤醒 call() 中的等待。
+        尚未启动进程的 chromedriver 服务（webdriver.Chrome() 构造中）留在列表里，
+        监督线程在等待工作线程退出期间会重复调用 cancel()，进程出现后即被结束。
+        """
+        self._cancelled.set()
+        with self._lock:
+            resources = self._resources
+            self._resources = [r for r in resources if self._is_unstarted_service(r)]
+        for resource in resources:
+            self._release(resource)
+
+    @staticmethod
+    def _is_unstarted_service(resource) -> bool:
+        if isinstance(resource, (subprocess.Popen, threading.Event)):
+            return False
+        return getattr(resource, "process", None) is None
+
+    @staticmethod
+    def _release(resource):
+        try:
+            if isinstance(resource, subprocess.Popen):
+                resource.kill()
+            elif isinstance(resource, threading.Event):
+                resource.set()
+            elif getattr(resource, "process", None) is not None:
+                # chromedriver 服务：结束整个进程组（含 chrome）
+                pgid = _service_pgid(resource)
+                if pgid is not None:
+                    os.killpg(pgid, signal.SIGKILL)
+                else:
+                    resource.process.kill()
+        except Exception:
+            pass
+
+
+def run_subprocess(cmd: list[str], timeout: float, deadline: CycleDeadline) -> subprocess.CompletedProcess:
+    """subprocess.run 的可取消版本：进程登记到 deadline，超时/取消时被 kill"""
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True) as proc:
+        deadline.register(proc)
+        try:
+            stdout, stderr = proc.communicate(timeout=deadline.timeout(timeout))
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.communicate()
+            raise
+        finally:
+            deadline.unregister(proc)
+    deadline.check()
+    return subprocess.CompletedProcess(cmd, proc.returncode, stdout, stderr)
 
 
 # ==================== IP 工具函数 ====================
@@ -264,18 +682,21 @@ def parse_ip_response(url: str, text: str) -> str | None:
     return extract_ip_from_text(text)
 
 
-def get_public_ip_via_curl(source_ip: str, interface_index: int) -> str | None:
+def get_public_ip_via_curl(source_ip: str, interface_index: int,
+                           deadline: CycleDeadline | None = None) -> str | None:
     """通过 curl 绑定源 IP 获取公网 IP"""
+    deadline = deadline or CycleDeadline()
     services = build_service_list(interface_index)
     for url, isp_key in services:
+        start_time = time.time()
         try:
-            result = subprocess.run(
+            result = run_subprocess(
                 [
                     "curl", "--interface", source_ip,
                     "--connect-timeout", "8", "--max-time", "12",
                     "--retry", "1", "-s", url,
                 ],
-                capture_output=True, text=True, timeout=15,
+                timeout=15, deadline=deadline,
             )
             if result.returncode != 0:
                 continue
@@ -283,15 +704,21 @@ def get_public_ip_via_curl(source_ip: str, interface_index: int) -> str | None:
             if ip and is_valid_ip(ip) and is_public_ip(ip):
                 isp_name = ISP_NAMES.get(isp_key, isp_key)
                 label = INTERFACE_LABELS[interface_index]
-                log.info("%s IP: %s (运营商: %s, 来源: %s)", label, ip, isp_name, url)
+                log.info("%s IP: %s (运营商: %s, 来源: %s)", label, ip, isp_name, url,
+                         extra={"service": url, "latency": time.time() - start_time})
                 return ip
         except Exception:
             continue
     return None
 
 
-def get_public_ip_via_requests(source_ip: str, interface_index: int) -> str | None:
+def get_public_ip_via_requests(source_ip: str, interface_index: int,
+                               deadline: CycleDeadline | None = None) -> str | None:
     """通过 Python requests 绑定源 IP 获取公网 IP（curl 失败时的后备方案）"""
+    import requests
+
+    deadline = deadline or CycleDeadline()
+
     # 自定义 Adapter 绑定源地址
     class SourceBindingAdapter(requests.adapters.HTTPAdapter):
         def __init__(self, src_ip, **kwargs):
@@ -314,34 +741,41 @@ def get_public_ip_via_requests(source_ip: str, interface_index: int) -> str | No
         }
         services = build_service_list(interface_index)
         for url, isp_key in services:
+            start_time = time.time()
             try:
-                resp = session.get(url, headers=headers, timeout=10)
+                resp = deadline.call(session.get, url, headers=headers,
+                                     timeout=deadline.timeout(REQUESTS_PROBE_TIMEOUT))
                 if resp.status_code != 200:
                     continue
                 ip = parse_ip_response(url, resp.text)
                 if ip and is_valid_ip(ip) and is_public_ip(ip):
                     isp_name = ISP_NAMES.get(isp_key, isp_key)
                     label = INTERFACE_LABELS[interface_index]
-                    log.info("%s IP (requests): %s (运营商: %s)", label, ip, isp_name)
+                    log.info("%s IP (requests): %s (运营商: %s)", label, ip, isp_name,
+                             extra={"service": url, "latency": time.time() - start_time})
                     return ip
             except Exception:
+                deadline.check()
                 continue
     finally:
         session.close()
     return None
 
 
-def detect_all_interface_ips(interface_configs: list[dict]) -> list[str | None]:
+def detect_all_interface_ips(interface_configs: list[dict],
+                             deadline: CycleDeadline | None = None) -> list[str | None]:
     """
     检测所有接口的公网 IP。
     返回 (has_changed, [ip_or_None, ...])
     """
+    deadline = deadline or CycleDeadline()
     log.info("开始获取各接口IP地址...")
     new_ips: list[str | None] = []
 
     for i, iface_cfg in enumerate(interface_configs):
         iface_name = iface_cfg["interface"]
         label = INTERFACE_LABELS[i] if i < len(INTERFACE_LABELS) else f"接口{i+1}"
+        set_log_context(interface=iface_name)
         log.info("检查 %s - 网卡: %s", label, iface_name)
 
         local_ip = get_interface_ip(iface_name)
@@ -353,17 +787,18 @@ def detect_all_interface_ips(interface_configs: list[dict]) -> list[str | None]:
         log.info("%s 本地IP: %s", label, local_ip)
 
         # 优先用 curl（更快），失败则用 requests
-        public_ip = get_public_ip_via_curl(local_ip, i)
+        public_ip = get_public_ip_via_curl(local_ip, i, deadline)
         if public_ip is None:
             log.info("curl 获取失败，尝试 Python requests...")
-            public_ip = get_public_ip_via_requests(local_ip, i)
+            public_ip = get_public_ip_via_requests(local_ip, i, deadline)
 
         if public_ip is None:
             log.error("%s 公网IP获取失败", label)
         new_ips.append(public_ip)
 
         if i < len(interface_configs) - 1:
-            time.sleep(2)
+            deadline.sleep(2)
+    set_log_context(interface=None)
 
     # 检查是否有重复 IP（可能表示线路未正确区分）
     valid = [ip for ip in new_ips if ip]
@@ -380,6 +815,8 @@ def detect_all_interface_ips(interface_configs: list[dict]) -> list[str | None]:
 # ==================== Chrome 浏览器 ====================
 def setup_chrome_options() -> webdriver.ChromeOptions:
     """配置 Chrome 选项（headless、低内存）"""
+    from selenium import webdriver
+
     options = webdriver.ChromeOptions()
     # 基础：headless + 无沙箱
     options.add_argument("--headless=new")
@@ -414,36 +851,172 @@ def setup_chrome_options() -> webdriver.ChromeOptions:
     return options
 
 
-def cleanup_chrome_processes():
-    """清理残留 Chrome 进程"""
-    for pattern in ["chrome", "chromedriver", "chromium"]:
+def create_chrome_service() -> Service:
+    """创建 chromedriver 服务，并放入独立的进程组（chrome 子进程随之继承）"""
+    from selenium.webdriver.chrome.service import Service
+
+    popen_kw = {}
+    if os.name == "posix":
+        popen_kw["start_new_session"] = True
+    return Service(popen_kw=popen_kw)
+
+
+def _service_pgid(service: Service | None) -> int | None:
+    """取 chromedriver 所在进程组 ID（独立会话下即其 PID）"""
+    process = getattr(service, "process", None)
+    if process is None or os.name != "posix":
+        return None
+    return process.pid
+
+
+def _group_exists(pgid: int, process: subprocess.Popen | None) -> bool:
+    """廉价检查：chromedriver 仍在运行，或进程组仍存在（可能只剩僵尸）"""
+    if process is not None and process.poll() is None:
+        return True
+    try:
+        os.killpg(pgid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+def _only_zombies_left(pgid: int) -> bool:
+    """扫描一次 /proc，确认进程组只剩等待其他父进程回收的僵尸；无 /proc 时无法判断"""
+    return Path("/proc").is_dir() and not _list_group_pids(pgid)
+
+
+def _reap_group(pgid: int, process: subprocess.Popen | None):
+    """
+    回收进程组内已退出的子进程。chromedriver 交给 Popen 回收以保留其退出码；
+    其余的是容器内本程序作为 PID 1 时挂过来的孤儿 chrome，直接 waitpid。
+    """
+    if process is not None:
+        process.poll()
+    if not hasattr(os, "waitid"):
+        return
+    while True:
         try:
-            subprocess.run(
-                ["pkill", "-f", pattern],
-                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
-            )
+            # WNOWAIT 只查看不回收，先确认不是 chromedriver 再 waitpid
+            info = os.waitid(os.P_PGID, pgid, os.WEXITED | os.WNOHANG | os.WNOWAIT)
+        except ChildProcessError:
+            return
+        if info is None:
+            return
+        if process is not None and info.si_pid == process.pid:
+            if process.poll() is None:
+                return
+            continue
+        os.waitpid(info.si_pid, 0)
+
+
+def _wait_group_exit(pgid: int, process: subprocess.Popen | None, deadline: float) -> bool:
+    """
+    等待进程组全部退出，返回是否在期限内退出。轮询只用 poll()/killpg(0)；
+    chromedriver 已退出而进程组仍在时扫描一次 /proc 排除僵尸，期限到时再确认一次。
+    """
+    scanned = False
+    while True:
+        _reap_group(pgid, process)
+        if not _group_exists(pgid, process):
+            return True
+        if not scanned and (process is None or process.returncode is not None):
+            scanned = True
+            if _only_zombies_left(pgid):
+                return True
+        if time.time() >= deadline:
+            return _only_zombies_left(pgid)
+        time.sleep(0.1)
+
+
+def _iter_proc_stats():
+    """遍历 /proc，产出 (pid, state, ppid, pgrp)；非 Linux 下为空"""
+    for entry in Path("/proc").glob("[0-9]*"):
+        try:
+            stat = (entry / "stat").read_text()
+        except OSError:
+            continue
+        # comm 字段可能含空格，从最后一个 ')' 之后解析：state ppid pgrp ...
+        fields = stat.rsplit(")", 1)[-1].split()
+        if len(fields) > 2:
+            yield int(entry.name), fields[0], int(fields[1]), int(fields[2])
+
+
+def _list_group_pids(pgid: int) -> list[int]:
+    """从 /proc 列出进程组内仍存活的 PID（仅用于泄漏报告）"""
+    return [pid for pid, state, _, pgrp in _iter_proc_stats() if state != "Z" and pgrp == pgid]
+
+
+def teardown_browser(driver: webdriver.Chrome | None = None, service: Service | None = None,
+                     timeout: float = CHROME_QUIT_TIMEOUT) -> float:
+    """
+    关闭浏览器：先 driver.quit() 优雅退出，超过期限后只 SIGKILL 本程序拉起的进程组，
+    不会波及宿主上其他用户的浏览器。返回耗时（秒）。
+    """
+    start_time = time.time()
+    deadline = start_time + timeout
+    if service is None and driver is not None:
+        service = getattr(driver, "service", None)
+    pgid = _service_pgid(service)
+
+    def _quit():
+        try:
+            if driver is not None:
+                driver.quit()
+            elif service is not None:
+                service.stop()
         except Exception:
             pass
-    time.sleep(1)
 
+    # quit 可能卡在无响应的 chromedriver 上，放到线程里按期限等待
+    quitter = threading.Thread(target=_quit, name="chrome-quit", daemon=True)
+    quitter.start()
+    quitter.join(timeout)
+
+    process = getattr(service, "process", None)
+    if pgid is not None and not _wait_group_exit(pgid, process, deadline):
+        log.warning("浏览器未在 %.0fs 内退出，强制结束进程组 %d", timeout, pgid)
+        try:
+            os.killpg(pgid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        if not _wait_group_exit(pgid, process, time.time() + 1):
+            log.warning("进程组 %d 仍有残留进程: %s", pgid, _list_group_pids(pgid))
 
-def launch_browser(wechat_url: str, cookie_header: str) -> webdriver.Chrome | None:
+    elapsed = time.time() - start_time
+    log.info("浏览器已关闭，耗时 %.1fs", elapsed)
+    return elapsed
+
+
+def launch_browser(wechat_url: str, cookie_header: str,
+                   deadline: CycleDeadline | None = None) -> webdriver.Chrome | None:
     """
     启动浏览器并访问企业微信，应用 cookie 完成登录。
-    失败时内部重试 CHROME_MAX_RETRIES 次。
+    失败时内部重试 CHROME_MAX_RETRIES 次；chromedriver 服务登记到 deadline，
+    超时取消时整个进程组被结束，卡住的驱动调用随之返回。
     """
+    from selenium import webdriver
+    from selenium.common.exceptions import TimeoutException
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.webdriver.support.ui import WebDriverWait
+
+    deadline = deadline or CycleDeadline()
     log.info("启动Chrome浏览器访问企业微信")
 
     for attempt in range(CHROME_MAX_RETRIES):
         driver = None
+        service = None
         start_time = time.time()
         try:
+            deadline.check()
             if attempt > 0:
-                cleanup_chrome_processes()
                 log.info("第 %d 次尝试启动浏览器...", attempt + 1)
 
             options = setup_chrome_options()
-            service = Service()
+            service = create_chrome_service()
+            deadline.register(service)
             driver = webdriver.Chrome(service=service, options=options)
             driver.set_page_load_timeout(15)
             driver.set_script_timeout(10)
@@ -484,30 +1057,141 @@ def launch_browser(wechat_url: str, cookie_header: str) -> webdriver.Chrome | No
             except TimeoutException:
                 log.info("登录状态验证成功")
 
+            deadline.check()
             log.info("浏览器启动完成，总耗时 %.1fs", time.time() - start_time)
             return driver
 
+        except CycleCancelled:
+            teardown_browser(driver, service)
+            raise
+
         except Exception as e:
             log.error("浏览器启动异常 (%d/%d): %s", attempt + 1, CHROME_MAX_RETRIES, e)
-            if driver:
-                try:
-                    driver.quit()
-                except Exception:
-                    pass
+            teardown_browser(driver, service)
+            deadline.unregister(service)
             if attempt < CHROME_MAX_RETRIES - 1:
                 wait = CHROME_RETRY_DELAY * (attempt + 1)
                 log.info("等待 %d 秒后重试...", wait)
-                time.sleep(wait)
+                deadline.sleep(wait)
 
     return None
 
 
+# ==================== 失败现场快照 ====================
+class ArtifactStore:
+    """
+    失败现场存储：gzip 压缩落盘，总大小与文件数超出预算时
+    按最近使用时间淘汰最旧的文件（最新写入的一份始终保留）。
+    只管理以 names 中前缀命名（<name>_<时间戳>.*）的文件，目录中的其他文件
+    （配置、状态文件，或共用目录的另一个 store 的文件）不计入预算、也不会被删除。
+    """
+
+    def __init__(self, directory: str | Path, names: tuple[str, ...],
+                 max_bytes: int = ARTIFACT_MAX_BYTES, max_count: int = ARTIFACT_MAX_COUNT):
+        self.directory = Path(directory)
+        self.names = names
+        self.max_bytes = max_bytes
+        self.max_count = max_count
+        self._own_file = re.compile(
+            rf"^(?:{'|'.join(map(re.escape, names))})_\d{{8}}-\d{{6}}-\d{{6}}\.[\w.]+$"
+        )
+
+    def save(self, name: str, data: bytes, suffix: str, compress: bool = True) -> Path | None:
+        """写入一份快照并执行淘汰，返回文件路径"""
+        if name not in self.names:
+            raise ValueError(f"未登记的快照名: {name}")
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            ts = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+            if compress:
+                data = gzip.compress(data, compresslevel=6)
+                suffix += ".gz"
+            path = self.directory / f"{name}_{ts}{suffix}"
+            tmp = path.with_name(path.name + ".tmp")
+            tmp.write_bytes(data)
+            os.replace(tmp, path)
+        except OSError as e:
+            log.warning("保存现场快照失败: %s", e)
+            return None
+        self._evict(keep=path)
+        return path
+
+    def _evict(self, keep: Path):
+        """按 LRU 淘汰，直到满足数量和大小预算"""
+        entries = []
+        for p in self.directory.iterdir():
+            if not self._own_file.match(p.name) or not p.is_file():
+                continue
+            try:
+                st = p.stat()
+            except OSError:
+                continue
+            entries.append((max(st.st_atime, st.st_mtime), st.st_size, p))
+        entries.sort(key=lambda e: e[0])
+
+        total = sum(size for _, size, _ in entries)
+        count = len(entries)
+        for _, size, p in entries:
+            if count <= self.max_count and total <= self.max_bytes:
+                break
+            if p == keep:
+                continue
+            try:
+                p.unlink()
+                log.info("淘汰旧现场快照: %s", p.name)
+            except OSError:
+                continue
+            total -= size
+            count -= 1
+
+
+# 只抓取 IP 配置对话框区域，找不到再退回整个 body；在页面内截断，避免整页 DOM 经 chromedriver 传回
+_DIALOG_SNAPSHOT_JS = """
+var el = document.querySelector('.js_ipConfig_dialog') || document.body;
+return [location.href, el ? el.outerHTML.slice(0, arguments[0]) : ''];
+"""
+
+
+def capture_failure_artifact(driver: webdriver.Chrome, store: ArtifactStore,
+                             name: str = "error") -> Path | None:
+    """
+    保存失败现场。优先保存对话框区域的 HTML（一次脚本调用，体积小），
+    取不到时才退回整页 PNG 截图。
+    """
+    start_time = time.time()
+    path = None
+    try:
+        url, html = driver.execute_script(_DIALOG_SNAPSHOT_JS, ARTIFACT_HTML_LIMIT)
+        if html:
+            content = f"<!-- {url} -->\n{html}"
+            path = store.save(name, content.encode("utf-8"), ".html")
+    except Exception as e:
+        log.warning("获取页面 HTML 失败，改用截图: %s", e)
+
+    if path is None:
+        try:
+            # PNG 本身已压缩，不再 gzip
+            path = store.save(name, driver.get_screenshot_as_png(), ".png", compress=False)
+        except Exception as e:
+            log.warning("截图失败: %s", e)
+
+    if path:
+        log.info("现场快照已保存: %s (%.2fs)", path, time.time() - start_time)
+    return path
+
+
 # ==================== 企业微信 IP 更新 ====================
-def update_wecom_ip(driver: webdriver.Chrome, new_ips: list[str | None]) -> tuple[bool, str]:
+def update_wecom_ip(driver: webdriver.Chrome, new_ips: list[str | None],
+                    artifacts: ArtifactStore | None = None) -> tuple[bool, str]:
     """
     更新企业微信可信 IP 地址。
+    失败时若提供了 artifacts，则保存现场快照并把路径附在错误信息中。
     返回 (success, error_message)
     """
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.webdriver.support.ui import WebDriverWait
+
     try:
         # 过滤有效公网 IP 并去重
         valid_ips = []
@@ -562,15 +1246,10 @@ def update_wecom_ip(driver: webdriver.Chrome, new_ips: list[str | None]) -> tupl
     except Exception as e:
         error_msg = f"更改IP地址失败: {e}"
         log.error(error_msg)
-        # 保存截图
-        try:
-            ts = datetime.now().strftime("%Y%m%d-%H%M%S")
-            path = f"error_{ts}.png"
-            driver.save_screenshot(path)
-            log.info("错误截图已保存: %s", path)
-            error_msg += f"\n截图: {path}"
-        except Exception:
-            pass
+        if artifacts is not None:
+            path = capture_failure_artifact(driver, artifacts)
+            if path:
+                error_msg += f"\n现场快照: {path}"
         return False, error_msg
 
 
@@ -588,6 +1267,8 @@ class Notifier:
     def _post(self, content: str) -> bool:
         if not self.webhook_url:
             return False
+        import requests
+
         try:
             resp = requests.post(
                 self.webhook_url,
@@ -639,21 +1320,44 @@ class Notifier:
                 self.report_error(error_detail)
             self._last_cycle_ok = False
 
+    def dump_state(self) -> dict:
+        """导出限流状态，供单次运行模式持久化"""
+        return {
+            "last_error_time": self._last_error_time.isoformat() if self._last_error_time else None,
+            "last_recovery_time": self._last_recovery_time.isoformat() if self._last_recovery_time else None,
+            "error_sent_for_current_failure": self._error_sent_for_current_failure,
+            "last_cycle_ok": self._last_cycle_ok,
+        }
+
+    def restore_state(self, state: dict):
+        """从 dump_state() 的结果恢复限流状态"""
+        for attr, key in (("_last_error_time", "last_error_time"),
+                          ("_last_recovery_time", "last_recovery_time")):
+            value = state.get(key)
+            setattr(self, attr, datetime.fromisoformat(value) if value else None)
+        self._error_sent_for_current_failure = bool(state.get("error_sent_for_current_failure", False))
+        self._last_cycle_ok = bool(state.get("last_cycle_ok", True))
+
 
 # ==================== Cookie 保活 ====================
-def keep_cookie_alive(wechat_url: str, cookie_header: str) -> bool:
+def keep_cookie_alive(wechat_url: str, cookie_header: str,
+                      deadline: CycleDeadline | None = None) -> bool:
     """
     用 requests 轻量请求访问企业微信页面，保持 cookie/session 不过期。
     不启动浏览器，内存开销极小（几 MB）。
     返回 True 表示 cookie 仍有效，False 表示已失效。
     """
+    import requests
+
+    deadline = deadline or CycleDeadline()
     headers = {
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
                        "AppleWebKit/537.36 Chrome/120.0.0.0 Safari/537.36",
         "Cookie": cookie_header,
     }
     try:
-        resp = requests.get(wechat_url, headers=headers, timeout=15, allow_redirects=True)
+        resp = deadline.call(requests.get, wechat_url, headers=headers,
+                             timeout=deadline.timeout(KEEPALIVE_TIMEOUT), allow_redirects=True)
         # 如果被重定向到登录页，说明 cookie 已失效
         if "loginpage_wx" in resp.url or "login" in resp.url.lower():
             log.warning("Cookie 已失效（被重定向到登录页）")
@@ -668,108 +1372,431 @@ def keep_cookie_alive(wechat_url: str, cookie_header: str) -> bool:
         return False
 
 
-# ==================== 主循环 ====================
-def main():
-    config = load_config()
-    settings = config["Settings"]
+# ==================== 性能剖析 ====================
+def _descendant_rss_kb() -> int:
+    """统计本进程所有子孙进程（chromedriver / chrome / curl）的 RSS 之和（KB）"""
+    children: dict[int, list[int]] = {}
+    for pid, _, ppid, _ in _iter_proc_stats():
+        children.setdefault(ppid, []).append(pid)
+
+    total = 0
+    stack = list(children.get(os.getpid(), []))
+    while stack:
+        pid = stack.pop()
+        stack.extend(children.get(pid, []))
+        try:
+            status = Path(f"/proc/{pid}/status").read_text()
+        except OSError:
+            continue
+        match = re.search(r"^VmRSS:\s+(\d+) kB", status, re.MULTILINE)
+        if match:
+            total += int(match.group(1))
+    return total
+
 
-    interface_configs = [
+class RssSampler:
+    """后台线程定期采样子进程 RSS，按当前周期阶段（phase）记录峰值"""
+
+    def __init__(self, interval: float = PROFILE_RSS_INTERVAL):
+        self.interval = interval
+        self.peak_by_phase: dict[str, int] = {}
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            rss = _descendant_rss_kb()
+            phase = _log_context.get("phase", "-")
+            if rss > self.peak_by_phase.get(phase, 0):
+                self.peak_by_phase[phase] = rss
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+class CycleProfiler:
+    """
+    按需剖析主循环：收到 SIGUSR1（或配置 profile_on_start）后，
+    对接下来 N 个周期做 cProfile + tracemalloc，并采样浏览器子进程 RSS。
+    结果写入有容量上限的目录：<name>.pstats 可用 `python -m pstats` 查看，
+    <name>.txt.gz 为内存分配 Top N、与上一周期的差异及 RSS 峰值。
+    周期内只采集数据，统计与写盘由 flush() 在周期时限之外完成。
+    """
+
+    def __init__(self, store: ArtifactStore, cycles: int = PROFILE_CYCLES):
+        self.store = store
+        self.cycles = cycles
+        self._remaining = 0
+        self._last_snapshot: tracemalloc.Snapshot | None = None
+        # 待写出的剖析结果：(profiler, snapshot, rss_peaks, 是否为本轮最后一个周期)
+        self._pending: list[tuple] = []
+
+    def request(self, cycles: int | None = None):
+        """安排剖析接下来的若干周期（可在信号处理函数中调用）"""
+        self._remaining = cycles or self.cycles
+
+    def install_signal_handler(self):
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.request())
+
+    @contextmanager
+    def cycle(self):
+        """包裹一个周期；未安排剖析时几乎无开销"""
+        if self._remaining <= 0:
+            yield
+            return
+
+        log.info("开始剖析本周期（剩余 %d 个）", self._remaining)
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        sampler = RssSampler()
+        sampler.start()
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            sampler.stop()
+            snapshot = tracemalloc.take_snapshot()
+            self._remaining -= 1
+            last = self._remaining <= 0
+            if last:
+                tracemalloc.stop()
+            self._pending.append((profiler, snapshot, sampler.peak_by_phase, last))
+
+    def flush(self):
+        """写出已完成周期的剖析结果（在周期时限之外调用）"""
+        while self._pending:
+            profiler, snapshot, rss_peaks, last = self._pending.pop(0)
+            self._dump(profiler, snapshot, rss_peaks)
+            if last:
+                self._last_snapshot = None
+                log.info("剖析结束")
+
+    def _dump(self, profiler: cProfile.Profile, snapshot: tracemalloc.Snapshot,
+              rss_peaks: dict[str, int]):
+        profiler.create_stats()
+        stats_path = self.store.save("profile", marshal.dumps(profiler.stats), ".pstats", compress=False)
+
+        lines = ["# 子进程 RSS 峰值（KB，按阶段）"]
+        lines += [f"{phase}: {rss}" for phase, rss in rss_peaks.items()] or ["(无子进程)"]
+        lines += ["", f"# 内存分配 Top {PROFILE_TOP_ALLOCATIONS}"]
+        lines += [str(stat) for stat in snapshot.statistics("lineno")[:PROFILE_TOP_ALLOCATIONS]]
+        if self._last_snapshot is not None:
+            lines += ["", "# 与上一剖析周期相比"]
+            lines += [str(stat) for stat in
+                      snapshot.compare_to(self._last_snapshot, "lineno")[:PROFILE_TOP_ALLOCATIONS]]
+        self._last_snapshot = snapshot
+        mem_path = self.store.save("memory", "\n".join(lines).encode("utf-8"), ".txt")
+
+        log.info("剖析结果已保存: %s, %s", stats_path, mem_path)
+
+
+# ==================== 主流程 ====================
+
+def interface_configs_from(settings: dict) -> list[dict]:
+    """从配置中取出三条线路的网卡设置"""
+    return [
         {"interface": settings[f"interface{i+1}_interface"]}
         for i in range(3)
     ]
-    wechat_url = settings["wechatUrl"]
-    cookie_header = settings["cookie_header"]
-    interval = settings["detailsTime"]
-    webhook_url = settings.get("webhook_url", "")
 
-    notifier = Notifier(webhook_url)
-    current_ips: list[str | None] = [None, None, None]
 
-    log.info("企业微信三接口IP更新器启动")
-    for i, cfg in enumerate(interface_configs):
-        log.info("  接口%d (%s) - 网卡: %s", i + 1, INTERFACE_LABELS[i], cfg["interface"])
+class Updater:
+    """一次运行所需的配置与状态；单次模式与常驻循环共用"""
+
+    def __init__(self, settings: dict):
+        self.interface_configs = interface_configs_from(settings)
+        self.wechat_url = settings["wechatUrl"]
+        self.cookie_header = settings["cookie_header"]
+        self.interval = settings["detailsTime"]
+        self.cycle_timeout = settings.get("cycle_timeout", CYCLE_TIMEOUT)
+        self.notifier = Notifier(settings.get("webhook_url", ""))
+        self.artifacts = ArtifactStore(
+            settings.get("artifact_dir", ARTIFACT_DIR), names=("error",),
+            max_bytes=settings.get("artifact_max_bytes", ARTIFACT_MAX_BYTES),
+            max_count=settings.get("artifact_max_count", ARTIFACT_MAX_COUNT),
+        )
+        self.state_path = Path(settings.get("state_file", STATE_PATH))
+        self.profiler = CycleProfiler(
+            ArtifactStore(settings.get("profile_dir", PROFILE_DIR), names=("profile", "memory"),
+                          max_bytes=PROFILE_MAX_BYTES, max_count=PROFILE_MAX_COUNT),
+            cycles=settings.get("profile_cycles", PROFILE_CYCLES),
+        )
+        if settings.get("profile_on_start", False):
+            self.profiler.request()
+        self.current_ips: list[str | None] = [None, None, None]
+        # 超时取消后仍未退出的工作线程
+        self._stale_worker: threading.Thread | None = None
+
+    def load_state(self):
+        state = load_state(self.state_path)
+        ips = state.get("current_ips")
+        if isinstance(ips, list) and len(ips) == len(self.current_ips):
+            self.current_ips = ips
+        self.notifier.restore_state(state.get("notifier", {}))
+
+    def save_state(self):
+        save_state(self.state_path, {
+            "current_ips": self.current_ips,
+            "notifier": self.notifier.dump_state(),
+        })
+
+    def run_cycle(self, deadline: CycleDeadline) -> tuple[bool, str]:
+        """
+        执行一次 保活 → 检测 → （有变化时）更新 的周期。
+        返回 (cycle_ok, error_detail)，成功更新时同步 current_ips。
+        """
+        # 第零步：用轻量请求保活 cookie（不启动浏览器，几 MB 内存）
+        set_log_context(phase="keepalive")
+        if not keep_cookie_alive(self.wechat_url, self.cookie_header, deadline):
+            # 请求因时限到期而失败时不误报为 cookie 失效
+            deadline.check()
+            error_detail = "Cookie 已失效，请更新配置文件中的 cookie_header"
+            log.error(error_detail)
+            return False, error_detail
+
+        # 第一步：检测 IP（不需要浏览器）
+        set_log_context(phase="detect")
+        try:
+            new_ips = detect_all_interface_ips(self.interface_configs, deadline)
+        except Exception as e:
+            error_detail = f"IP检测异常: {e}"
+            log.error(error_detail)
+            return False, error_detail
+
+        # 判断是否有变化
+        changed = any(
+            new_ip is not None and new_ip != self.current_ips[i]
+            for i, new_ip in enumerate(new_ips)
+        )
+        if not changed:
+            log.info("所有接口IP均未变化，无需更新")
+            return True, ""
+
+        # 第二步：IP 有变化，才启动浏览器去更新企业微信
+        log.info("检测到IP变化，启动浏览器更新企业微信")
+        driver = None
+        try:
+            set_log_context(phase="launch_browser")
+            driver = launch_browser(self.wechat_url, self.cookie_header, deadline)
+            if not driver:
+                error_detail = "浏览器启动失败（重试3次后仍失败）"
+                log.error(error_detail)
+                return False, error_detail
+            set_log_context(phase="update")
+            ok, err = update_wecom_ip(driver, new_ips, self.artifacts)
+            if not ok:
+                log.error("IP变更失败: %s", err)
+                return False, err
+            # 已被取消的周期不再改动状态
+            deadline.check()
+            for i, ip in enumerate(new_ips):
+                if ip is not None:
+                    self.current_ips[i] = ip
+            log.info("IP变更成功")
+            return True, ""
+        finally:
+            if driver:
+                set_log_context(phase="teardown")
+                teardown_browser(driver)
+
+    def _supervise(self) -> tuple[bool, str]:
+        """
+        在工作线程中执行 run_cycle，超过 cycle_timeout 时取消：
+        kill 未完成的 curl 和浏览器进程组、放弃等待进行中的 requests 调用，
+        并记录超时所在阶段。
+        """
+        if self._stale_worker is not None and self._stale_worker.is_alive():
+            error_detail = "上一周期取消后工作线程仍未退出，跳过本周期"
+            log.error(error_detail)
+            return False, error_detail
+        self._stale_worker = None
+
+        deadline = CycleDeadline(self.cycle_timeout)
+        outcome: dict = {}
+
+        def _worker():
+            try:
+                with self.profiler.cycle():
+                    outcome["result"] = self.run_cycle(deadline)
+            except CycleCancelled as e:
+                outcome["cancelled_phase"] = e.phase
+            except Exception as e:
+                outcome["error"] = e
+
+        worker = threading.Thread(target=_worker, name="cycle-worker", daemon=True)
+        worker.start()
+        worker.join(self.cycle_timeout)
+
+        if not worker.is_alive():
+            if "error" in outcome:
+                raise outcome["error"]
+            if "result" in outcome:
+                return outcome["result"]
+
+        # 超时：工作线程已自行检测到时限（取其抛出时的阶段），或仍卡在当前阶段
+        phase = outcome.get("cancelled_phase") or _log_context.get("phase", "-")
+        error_detail = f"周期超时（{self.cycle_timeout}s），卡在阶段: {phase}"
+        log.error(error_detail)
+        if worker.is_alive():
+            grace_end = time.monotonic() + CYCLE_CANCEL_GRACE
+            while worker.is_alive() and time.monotonic() < grace_end:
+                # 重复取消：覆盖取消时尚未启动、之后才出现的 chromedriver
+                deadline.cancel()
+                worker.join(0.2)
+            if worker.is_alive():
+                log.error("工作线程在取消 %ds 后仍未退出", CYCLE_CANCEL_GRACE)
+                self._stale_worker = worker
+        return False, error_detail
+
+    def run_once(self) -> bool:
+        """执行一个周期并上报结果，异常不外抛"""
+        start_time = time.time()
+        set_log_context(cycle_id=uuid.uuid4().hex[:12])
+        try:
+            cycle_ok, error_detail = self._supervise()
+        except Exception as e:
+            cycle_ok, error_detail = False, f"主循环异常: {e}"
+            log.error(error_detail)
+        self.profiler.flush()
+        set_log_context(phase="report", interface=None)
+        self.notifier.on_cycle_result(cycle_ok, error_detail)
+        self.save_state()
+        elapsed = time.time() - start_time
+        log.info("本次循环耗时 %.1fs", elapsed, extra={"latency": elapsed})
+        set_log_context(cycle_id=None, phase=None)
+        return cycle_ok
 
-    # 检查 curl
+
+def check_curl() -> bool:
     try:
         subprocess.run(["curl", "--version"], capture_output=True, timeout=5)
+        return True
     except Exception:
+        return False
+
+
+def cmd_detect(args: argparse.Namespace, settings: dict) -> int:
+    """检测各线路公网 IP，以 JSON 输出到 stdout"""
+    interface_configs = interface_configs_from(settings)
+    ips = detect_all_interface_ips(interface_configs)
+    result = [
+        {"label": INTERFACE_LABELS[i], "interface": cfg["interface"], "ip": ip}
+        for i, (cfg, ip) in enumerate(zip(interface_configs, ips))
+    ]
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    return EXIT_OK if any(ips) else EXIT_FAILURE
+
+
+def cmd_update(args: argparse.Namespace, settings: dict) -> int:
+    """更新企业微信可信 IP；--once 只跑一个周期，否则常驻循环"""
+    updater = Updater(settings)
+    updater.load_state()
+
+    log.info("企业微信三接口IP更新器启动")
+    for i, cfg in enumerate(updater.interface_configs):
+        log.info("  接口%d (%s) - 网卡: %s", i + 1, INTERFACE_LABELS[i], cfg["interface"])
+
+    if not check_curl():
         log.error("curl 命令不可用，程序退出")
-        notifier.report_error("curl命令不可用")
-        return
+        updater.notifier.report_error("curl命令不可用")
+        updater.save_state()
+        return EXIT_ENV_ERROR
+
+    if args.once:
+        return EXIT_OK if updater.run_once() else EXIT_FAILURE
+
+    # kill -USR1 <pid>：剖析接下来的 profile_cycles 个周期
+    updater.profiler.install_signal_handler()
 
     while True:
-        cycle_ok = False
-        error_detail = ""
+        updater.run_once()
+        log.info("等待 %ds 后下次检查...", updater.interval)
+        time.sleep(updater.interval)
+
+
+def cmd_keepalive(args: argparse.Namespace, settings: dict) -> int:
+    """仅做 cookie 保活，返回 cookie 是否有效"""
+    ok = keep_cookie_alive(settings["wechatUrl"], settings["cookie_header"])
+    return EXIT_OK if ok else EXIT_FAILURE
+
+
+def cmd_bench(args: argparse.Namespace, settings: dict) -> int:
+    """测量各阶段耗时，以 JSON 输出到 stdout"""
+    timings: dict[str, float | None] = {}
+
+    start_time = time.time()
+    keep_cookie_alive(settings["wechatUrl"], settings["cookie_header"])
+    timings["keepalive"] = time.time() - start_time
+
+    for i, cfg in enumerate(interface_configs_from(settings)):
         start_time = time.time()
+        local_ip = get_interface_ip(cfg["interface"])
+        if local_ip:
+            get_public_ip_via_curl(local_ip, i)
+            timings[f"detect_{cfg['interface']}"] = time.time() - start_time
+        else:
+            timings[f"detect_{cfg['interface']}"] = None
 
-        try:
-            # 第零步：用轻量请求保活 cookie（不启动浏览器，几 MB 内存）
-            cookie_ok = keep_cookie_alive(wechat_url, cookie_header)
-            if not cookie_ok:
-                error_detail = "Cookie 已失效，请更新配置文件中的 cookie_header"
-                log.error(error_detail)
-                notifier.on_cycle_result(False, error_detail)
-                time.sleep(interval)
-                continue
+    if args.browser:
+        start_time = time.time()
+        driver = launch_browser(settings["wechatUrl"], settings["cookie_header"])
+        timings["launch_browser"] = time.time() - start_time
+        timings["teardown_browser"] = teardown_browser(driver) if driver else None
 
-            # 第一步：检测 IP（不需要浏览器）
-            try:
-                new_ips = detect_all_interface_ips(interface_configs)
-            except Exception as e:
-                error_detail = f"IP检测异常: {e}"
-                log.error(error_detail)
-                notifier.on_cycle_result(False, error_detail)
-                time.sleep(interval)
-                continue
+    print(json.dumps(
+        {k: round(v, 3) if v is not None else None for k, v in timings.items()},
+        ensure_ascii=False, indent=2,
+    ))
+    return EXIT_OK
 
-            # 判断是否有变化
-            changed = any(
-                new_ip is not None and new_ip != current_ips[i]
-                for i, new_ip in enumerate(new_ips)
-            )
 
-            if not changed:
-                cycle_ok = True
-                log.info("所有接口IP均未变化，无需更新")
-            else:
-                # 第二步：IP 有变化，才启动浏览器去更新企业微信
-                log.info("检测到IP变化，启动浏览器更新企业微信")
-                driver = None
-                try:
-                    driver = launch_browser(wechat_url, cookie_header)
-                    if not driver:
-                        error_detail = "浏览器启动失败（重试3次后仍失败）"
-                        log.error(error_detail)
-                    else:
-                        ok, err = update_wecom_ip(driver, new_ips)
-                        if ok:
-                            for i, ip in enumerate(new_ips):
-                                if ip is not None:
-                                    current_ips[i] = ip
-                            cycle_ok = True
-                            log.info("IP变更成功")
-                        else:
-                            error_detail = err
-                            log.error("IP变更失败: %s", err)
-                finally:
-                    if driver:
-                        try:
-                            driver.quit()
-                        except Exception:
-                            pass
-                        cleanup_chrome_processes()
-
-            notifier.on_cycle_result(cycle_ok, error_detail)
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="企业微信可信IP自动更新器")
+    parser.add_argument("--log-format", choices=["text", "json"], help="日志格式（覆盖配置文件 log_format）")
+    parser.add_argument("--log-queue", action="store_true", default=None,
+                        help="异步写日志（覆盖配置文件 log_queue）")
+    sub = parser.add_subparsers(dest="command")
 
-        except Exception as e:
-            error_detail = f"主循环异常: {e}"
-            log.error(error_detail)
-            notifier.on_cycle_result(False, error_detail)
+    p = sub.add_parser("detect", help="检测各线路公网 IP 并输出 JSON")
+    p.set_defaults(func=cmd_detect)
 
-        elapsed = time.time() - start_time
-        log.info("本次循环耗时 %.1fs，等待 %ds 后下次检查...", elapsed, interval)
-        time.sleep(interval)
+    p = sub.add_parser("update", help="更新企业微信可信 IP（默认常驻循环）")
+    p.add_argument("--once", action="store_true", help="只执行一个周期后退出，适合定时任务")
+    p.set_defaults(func=cmd_update)
+
+    p = sub.add_parser("keepalive", help="仅做 cookie 保活")
+    p.set_defaults(func=cmd_keepalive)
+
+    p = sub.add_parser("bench", help="测量各阶段耗时并输出 JSON")
+    p.add_argument("--browser", action="store_true", help="同时测量浏览器启动/关闭耗时")
+    p.set_defaults(func=cmd_bench)
+
+    # 不带子命令时保持原有行为：常驻循环更新
+    parser.set_defaults(func=cmd_update, once=False)
+    return parser
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = build_parser().parse_args(argv)
+    config = load_config()
+    settings = config["Settings"]
+    setup_logging(
+        args.log_format or settings.get("log_format", "text"),
+        args.log_queue if args.log_queue is not None else settings.get("log_queue", False),
+        settings.get("log_rate_limit", 0),
+        settings.get("log_rate_window", LOG_RATE_WINDOW),
+    )
+    return args.func(args, settings)
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())